@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent import futures
+from typing import Any, Dict, List, Optional, Tuple
+
+import gpt_vision_aio_publisher
+import gpt_vision_publisher
+import grpc
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "lib/grpc"))
+import gpt_server_pb2
+import gpt_server_pb2_grpc
+import voice_server_pb2
+import voice_server_pb2_grpc
+
+# スレッドプール版とgrpc.aio版のGptServerに同時にリクエストを送り、
+# 最初の音声がvoice_serverに届くまでの時間とメモリ使用量を比較する。
+# 途中の認識結果(is_finish=False)と最終の認識結果(is_finish=True)のリクエストをそれぞれ送る。
+# 途中の認識結果はどちらもChatStreamAkariGrpcのchat_and_motionをスレッドで実行する。
+# LLMの代わりに一定時間待ってから文章を返すスタンドインを用いる。
+# voice_serverのスタンドインがlocalhost:10002を使用するため、本物のvoice_serverは停止しておくこと。
+
+FIRST_SENTENCE_DELAY = 0.5  # 最初の一文が返るまでの時間[s]
+SENTENCE_INTERVAL = 0.2  # 以降の一文毎の間隔[s]
+SENTENCE_NUM = 3
+
+
+def request_id_from_messages(messages: List[Any]) -> str:
+    return messages[-1]["content"].split("。")[0].lstrip("「")
+
+
+class StandInChatStream(object):
+    """
+    ChatStreamAkariGrpcの代わりに一定時間待ってから文章を返すクラス
+    """
+
+    last_char = ["。", "！", "？", "!", "?", "\n"]
+
+    def __init__(self) -> None:
+        self.motion_stub = None
+
+    def create_message(self, content: str, role: str = "user") -> Dict[str, Any]:
+        return {"role": role, "content": content}
+
+    def create_vision_message(
+        self, text: str, image: np.ndarray, model: Optional[str] = None, **kwargs: Any
+    ) -> Dict[str, Any]:
+        return {"role": "user", "content": text}
+
+    def chat(self, messages: List[Any], model: Optional[str] = None, **kwargs: Any):
+        request_id = request_id_from_messages(messages)
+        time.sleep(FIRST_SENTENCE_DELAY)
+        for i in range(SENTENCE_NUM):
+            if i > 0:
+                time.sleep(SENTENCE_INTERVAL)
+            yield f"{request_id}:{i}。"
+
+    def chat_and_motion(self, messages: List[Any], **kwargs: Any):
+        return self.chat(messages)
+
+    def send_reserved_motion(self) -> bool:
+        return True
+
+
+class StandInAsyncChatStream(object):
+    """
+    AsyncChatStreamの代わりに一定時間待ってから文章を返すクラス
+    """
+
+    def __init__(self, last_char: List[str], **kwargs: Any) -> None:
+        self.last_char = last_char
+
+    @staticmethod
+    def supports(model: str) -> bool:
+        return True
+
+    async def chat(self, messages: List[Any], model: str, temperature: float = 0.7):
+        request_id = request_id_from_messages(messages)
+        await asyncio.sleep(FIRST_SENTENCE_DELAY)
+        for i in range(SENTENCE_NUM):
+            if i > 0:
+                await asyncio.sleep(SENTENCE_INTERVAL)
+            yield f"{request_id}:{i}。"
+
+    async def send_motion(self, name: str) -> bool:
+        return True
+
+
+class StandInVoiceServer(voice_server_pb2_grpc.VoiceServerServiceServicer):
+    """
+    リクエスト毎に最初の音声が届いた時刻を記録するvoice_server
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.first_voice: Dict[str, float] = {}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.first_voice = {}
+
+    def SetText(
+        self, request: voice_server_pb2.SetTextRequest(), context: grpc.ServicerContext
+    ) -> voice_server_pb2.SetTextReply:
+        now = time.time()
+        request_id = request.text.split(":")[0]
+        with self.lock:
+            if request_id not in self.first_voice:
+                self.first_voice[request_id] = now
+        return voice_server_pb2.SetTextReply(success=True)
+
+
+def run_thread_server(port: str, ready: Any, stop: Any, concurrency: int) -> None:
+    gpt_server = gpt_vision_publisher.GptServer(vision_model="stand-in")
+    gpt_server.update_frame(np.zeros((1080, 1920, 3), dtype=np.uint8))
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=concurrency))
+    gpt_server_pb2_grpc.add_GptServerServiceServicer_to_server(gpt_server, server)
+    server.add_insecure_port("127.0.0.1:" + port)
+    server.start()
+    ready.set()
+    stop.wait()
+    server.stop(0)
+
+
+async def run_aio_server(
+    port: str,
+    ready: Any,
+    stop: Any,
+    max_streams: int,
+    max_rpcs: Optional[int],
+    executor_workers: int,
+) -> None:
+    gpt_server = gpt_vision_aio_publisher.AioGptServer(
+        vision_model="stand-in",
+        chat_model="stand-in",
+        max_streams=max_streams,
+        executor_workers=executor_workers,
+    )
+    gpt_server.update_frame(np.zeros((1080, 1920, 3), dtype=np.uint8))
+    server = await gpt_vision_aio_publisher.serve(
+        gpt_server, "127.0.0.1", port, max_rpcs
+    )
+    ready.set()
+    while not stop.is_set():
+        await asyncio.sleep(0.1)
+    await server.stop(0)
+
+
+def run_server(kind: str, port: str, ready: Any, stop: Any, args: Any) -> None:
+    # 発話ログを抑制する
+    sys.stdout = open(os.devnull, "w")
+    gpt_vision_publisher.ChatStreamAkariGrpc = StandInChatStream
+    gpt_vision_aio_publisher.ChatStreamAkariGrpc = StandInChatStream
+    gpt_vision_aio_publisher.AsyncChatStream = StandInAsyncChatStream
+    if kind == "thread":
+        run_thread_server(port, ready, stop, args.concurrency)
+    else:
+        asyncio.run(
+            run_aio_server(
+                port,
+                ready,
+                stop,
+                args.concurrency,
+                args.max_rpcs,
+                args.executor_workers,
+            )
+        )
+
+
+def read_proc_status(pid: int) -> Dict[str, str]:
+    status = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            status[key] = value.strip()
+    return status
+
+
+def send_request(
+    stub: Any, request_id: str, is_finish: bool
+) -> Tuple[str, float, bool]:
+    start = time.time()
+    try:
+        stub.SetGpt(
+            gpt_server_pb2.SetGptRequest(text=request_id, is_finish=is_finish)
+        )
+        success = True
+    except grpc.RpcError:
+        success = False
+    return request_id, start, success
+
+
+def run_requests(
+    stub: Any, voice_server: StandInVoiceServer, prefix: str, is_finish: bool, n: int
+) -> Tuple[List[float], int]:
+    voice_server.reset()
+    with futures.ThreadPoolExecutor(max_workers=n) as executor:
+        results = list(
+            executor.map(
+                lambda i: send_request(stub, f"{prefix}{i:04d}", is_finish), range(n)
+            )
+        )
+    latencies = []
+    errors = 0
+    for request_id, start, success in results:
+        if not success or request_id not in voice_server.first_voice:
+            errors += 1
+            continue
+        latencies.append(voice_server.first_voice[request_id] - start)
+    return latencies, errors
+
+
+def bench(kind: str, voice_server: StandInVoiceServer, args: Any) -> None:
+    # gRPCはスレッド起動後のforkに対応していないため、spawnでサーバのプロセスを起動する
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    stop = context.Event()
+    process = context.Process(
+        target=run_server, args=(kind, args.port, ready, stop, args)
+    )
+    process.start()
+    ready.wait()
+    channel = grpc.insecure_channel("127.0.0.1:" + args.port)
+    stub = gpt_server_pb2_grpc.GptServerServiceStub(channel)
+    results = {}
+    for is_finish, prefix in ((False, "partial"), (True, "finish")):
+        results[prefix] = run_requests(
+            stub, voice_server, prefix, is_finish, args.requests
+        )
+    status = read_proc_status(process.pid)
+    channel.close()
+    stop.set()
+    process.join()
+    if kind == "thread":
+        setting = f"max_workers {args.concurrency}"
+    else:
+        setting = (
+            f"max_streams {args.concurrency}, max_rpcs {args.max_rpcs}, "
+            f"executor_workers {args.executor_workers}"
+        )
+    print(
+        f"{kind} ({setting}): "
+        f"peak memory {status['VmHWM']}, threads {status['Threads']}"
+    )
+    for prefix, (latencies, errors) in results.items():
+        latency_ms = np.array(latencies) * 1000
+        print(
+            f"  {prefix}: requests {args.requests}, errors {errors}, "
+            f"time to first voice p50 {np.percentile(latency_ms, 50):.1f}ms "
+            f"p99 {np.percentile(latency_ms, 99):.1f}ms"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--port", help="Gpt server port number", default="10001", type=str
+    )
+    parser.add_argument(
+        "-n",
+        "--requests",
+        help="Number of concurrent SetGpt requests",
+        default=50,
+        type=int,
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        help="Thread pool size of thread server and max_streams of aio server",
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        "--max_rpcs",
+        help="Max number of concurrent rpcs for aio server",
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "--executor_workers",
+        help="Number of threads for image encoding in aio server",
+        default=4,
+        type=int,
+    )
+    args = parser.parse_args()
+    voice_server = StandInVoiceServer()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.requests))
+    voice_server_pb2_grpc.add_VoiceServerServiceServicer_to_server(
+        voice_server, server
+    )
+    server.add_insecure_port("localhost:10002")
+    server.start()
+    bench("thread", voice_server, args)
+    bench("aio", voice_server, args)
+    server.stop(0)
+
+
+if __name__ == "__main__":
+    main()
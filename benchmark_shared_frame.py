@@ -0,0 +1,130 @@
+import argparse
+import multiprocessing
+import resource
+import time
+from typing import Any, List, Tuple
+
+import numpy as np
+from lib.shared_frame import SharedFrameReader, SharedFrameWriter
+
+# 共有メモリのリングバッファとpickle(multiprocessing.Pipe)での画像受け渡しの遅延、CPU時間を比較する
+
+
+def cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def shm_writer(
+    name: str, shape: Tuple[int, ...], fps: int, count: int, ready: Any, result: Any
+) -> None:
+    writer = SharedFrameWriter(shape, name=name)
+    ready.set()
+    frame = np.random.randint(0, 255, shape, dtype=np.uint8)
+    metadata = {"tracklets": [{"id": 0, "label": "person", "z": 1000.0}]}
+    start = cpu_time()
+    for _ in range(count):
+        writer.write(frame, metadata)
+        time.sleep(1.0 / fps)
+    result.put(cpu_time() - start)
+    # 読み込み側が最後の画像を読むまで待つ
+    time.sleep(0.5)
+    writer.close()
+
+
+def pickle_writer(
+    conn: Any, shape: Tuple[int, ...], fps: int, count: int, result: Any
+) -> None:
+    frame = np.random.randint(0, 255, shape, dtype=np.uint8)
+    metadata = {"tracklets": [{"id": 0, "label": "person", "z": 1000.0}]}
+    start = cpu_time()
+    for _ in range(count):
+        conn.send((time.time(), frame, metadata))
+        time.sleep(1.0 / fps)
+    conn.send(None)
+    result.put(cpu_time() - start)
+
+
+def bench_shm(
+    shape: Tuple[int, ...], fps: int, count: int
+) -> Tuple[List[float], float, float]:
+    name = "akari_frame_bench"
+    ready = multiprocessing.Event()
+    result: Any = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=shm_writer, args=(name, shape, fps, count, ready, result)
+    )
+    process.start()
+    ready.wait()
+    reader = SharedFrameReader(name)
+    latencies = []
+    last_seq = 0
+    start = cpu_time()
+    while last_seq < count:
+        shared_frame = reader.read_next(last_seq)
+        if shared_frame is None:
+            break
+        # 画素に触れて、実際に読み出せる状態であることを確認する
+        int(shared_frame.frame[0, 0, 0])
+        latencies.append(time.time() - shared_frame.timestamp)
+        last_seq = shared_frame.seq
+        del shared_frame
+    reader_cpu = cpu_time() - start
+    reader.close()
+    writer_cpu = result.get()
+    process.join()
+    return latencies, reader_cpu, writer_cpu
+
+
+def bench_pickle(
+    shape: Tuple[int, ...], fps: int, count: int
+) -> Tuple[List[float], float, float]:
+    recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+    result: Any = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=pickle_writer, args=(send_conn, shape, fps, count, result)
+    )
+    process.start()
+    latencies = []
+    start = cpu_time()
+    while True:
+        data = recv_conn.recv()
+        if data is None:
+            break
+        timestamp, frame, metadata = data
+        int(frame[0, 0, 0])
+        latencies.append(time.time() - timestamp)
+    reader_cpu = cpu_time() - start
+    writer_cpu = result.get()
+    process.join()
+    return latencies, reader_cpu, writer_cpu
+
+
+def print_result(
+    name: str, latencies: List[float], reader_cpu: float, writer_cpu: float
+) -> None:
+    latency_ms = np.array(latencies) * 1000
+    print(
+        f"{name}: frames {len(latencies)}, "
+        f"latency p50 {np.percentile(latency_ms, 50):.3f}ms "
+        f"p99 {np.percentile(latency_ms, 99):.3f}ms, "
+        f"reader cpu {reader_cpu:.3f}s, writer cpu {writer_cpu:.3f}s"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", help="Frame width", default=1920, type=int)
+    parser.add_argument("--height", help="Frame height", default=1080, type=int)
+    parser.add_argument("-f", "--fps", help="Frame fps", default=10, type=int)
+    parser.add_argument(
+        "-n", "--count", help="Number of frames to send", default=100, type=int
+    )
+    args = parser.parse_args()
+    shape = (args.height, args.width, 3)
+    print_result("shared_memory", *bench_shm(shape, args.fps, args.count))
+    print_result("pickle", *bench_pickle(shape, args.fps, args.count))
+
+
+if __name__ == "__main__":
+    main()
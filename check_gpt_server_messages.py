@@ -0,0 +1,266 @@
+import asyncio
+import copy
+import json
+import os
+import sys
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+import gpt_vision_aio_publisher
+import gpt_vision_publisher
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "lib/grpc"))
+import gpt_server_pb2
+import motion_server_pb2
+import voice_server_pb2
+
+# 同じリクエストに対して、スレッドプール版とgrpc.aio版のGptServerが
+# LLMへ送るメッセージ、voice_serverへ送る文章、motion_serverへ送るモーションが一致するかを確認する。
+# LLMとvoice_server,motion_serverの代わりに、受け取った内容を記録するスタンドインを用いる。
+
+CHAT_SENTENCES = ["こんにちは。", "いい天気ですね。"]
+MOTION_SENTENCES = ["はい。"]
+
+# スタンドインが記録した内容。(種類, 内容)のリスト。
+events: List[Tuple[str, Any]] = []
+
+
+def split_chunks(text: str, size: int = 5) -> List[str]:
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+class RecordingChatStream(object):
+    """
+    ChatStreamAkariGrpcの代わりに、受け取ったメッセージを記録して一定の文章を返すクラス
+    """
+
+    last_char = ["。", "！", "？", "!", "?", "\n"]
+    judge_response = ""
+
+    def __init__(self) -> None:
+        self.motion_stub = RecordingMotionStub()
+        self.anthropic_client = SimpleNamespace(
+            messages=SimpleNamespace(stream=self.anthropic_stream)
+        )
+
+    def create_message(self, content: str, role: str = "user") -> Dict[str, Any]:
+        return {"role": role, "content": content}
+
+    def create_vision_message(
+        self, text: str, image: np.ndarray, model: Optional[str] = None, **kwargs: Any
+    ) -> Dict[str, Any]:
+        return {"role": "user", "content": [text, list(image.shape), model]}
+
+    def chat(self, messages: List[Any], model: Optional[str] = None, **kwargs: Any):
+        events.append(("llm", {"messages": copy.deepcopy(messages), "model": model}))
+        for sentence in CHAT_SENTENCES:
+            yield sentence
+
+    def chat_and_motion(self, messages: List[Any], **kwargs: Any):
+        events.append(
+            ("chat_and_motion", {"messages": copy.deepcopy(messages), **kwargs})
+        )
+        for sentence in MOTION_SENTENCES:
+            yield sentence
+
+    def send_reserved_motion(self) -> bool:
+        events.append(("reserved_motion", None))
+        return True
+
+    def anthropic_stream(self, **kwargs: Any) -> Any:
+        events.append(("anthropic", copy.deepcopy(kwargs)))
+        chunks = split_chunks(self.judge_response)
+
+        class Stream(object):
+            text_stream = iter(chunks)
+
+            def __enter__(self) -> Any:
+                return self
+
+            def __exit__(self, *args: Any) -> None:
+                pass
+
+        return Stream()
+
+
+class RecordingMotionStub(object):
+    def SetMotion(self, request: motion_server_pb2.SetMotionRequest) -> None:
+        events.append(("motion", request.name))
+
+
+class RecordingAsyncMotionStub(object):
+    async def SetMotion(self, request: motion_server_pb2.SetMotionRequest) -> None:
+        events.append(("motion", request.name))
+
+
+class RecordingVoiceStub(object):
+    def SetText(self, request: voice_server_pb2.SetTextRequest) -> None:
+        events.append(("voice", request.text))
+
+
+class RecordingAsyncVoiceStub(object):
+    async def SetText(self, request: voice_server_pb2.SetTextRequest) -> None:
+        events.append(("voice", request.text))
+
+
+class AsyncStream(object):
+    def __init__(self, items: List[Any]) -> None:
+        self.items = iter(items)
+
+    def __aiter__(self) -> Any:
+        return self
+
+    async def __anext__(self) -> Any:
+        try:
+            return next(self.items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class RecordingAsyncChatStream(gpt_vision_aio_publisher.AsyncChatStream):
+    """
+    AsyncChatStreamのLLMクライアントのみを、受け取ったリクエストを記録するスタンドインに置き換えたクラス
+    """
+
+    def __init__(self, last_char: List[str], **kwargs: Any) -> None:
+        super().__init__(last_char, **kwargs)
+        self.motion_stub = RecordingAsyncMotionStub()
+        self._openai_client = SimpleNamespace(
+            chat=SimpleNamespace(
+                completions=SimpleNamespace(create=self.openai_create)
+            )
+        )
+        self._anthropic_client = SimpleNamespace(
+            messages=SimpleNamespace(stream=self.anthropic_stream)
+        )
+
+    async def openai_create(self, **kwargs: Any) -> Any:
+        events.append(
+            (
+                "llm",
+                {
+                    "messages": copy.deepcopy(kwargs["messages"]),
+                    "model": kwargs["model"],
+                },
+            )
+        )
+        return AsyncStream(
+            [
+                SimpleNamespace(
+                    choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))]
+                )
+                for chunk in split_chunks("".join(CHAT_SENTENCES))
+            ]
+        )
+
+    def anthropic_stream(self, **kwargs: Any) -> Any:
+        events.append(("anthropic", copy.deepcopy(kwargs)))
+        chunks = split_chunks(RecordingChatStream.judge_response)
+
+        class Stream(object):
+            text_stream = AsyncStream(chunks)
+
+            async def __aenter__(self) -> Any:
+                return self
+
+            async def __aexit__(self, *args: Any) -> None:
+                pass
+
+        return Stream()
+
+
+def create_requests() -> List[gpt_server_pb2.SetGptRequest]:
+    return [
+        gpt_server_pb2.SetGptRequest(text="こんにちは", is_finish=False),
+        gpt_server_pb2.SetGptRequest(text="これは何ですか", is_finish=True),
+    ]
+
+
+def run_thread_server(
+    selective: bool, frame: np.ndarray
+) -> List[Tuple[str, Any]]:
+    events.clear()
+    if selective:
+        gpt_server: Any = gpt_vision_publisher.SelectiveGptServer(
+            vision_model="gpt-4-turbo"
+        )
+    else:
+        gpt_server = gpt_vision_publisher.GptServer(vision_model="gpt-4-turbo")
+    gpt_server.stub = RecordingVoiceStub()
+    gpt_server.update_frame(frame)
+    for request in create_requests():
+        gpt_server.SetGpt(request, None)
+        gpt_server.SendMotion(gpt_server_pb2.SendMotionRequest(), None)
+    return list(events)
+
+
+async def run_aio_server(
+    selective: bool, frame: np.ndarray
+) -> List[Tuple[str, Any]]:
+    events.clear()
+    if selective:
+        gpt_server: Any = gpt_vision_aio_publisher.AioSelectiveGptServer(
+            vision_model="gpt-4-turbo"
+        )
+    else:
+        gpt_server = gpt_vision_aio_publisher.AioGptServer(vision_model="gpt-4-turbo")
+    gpt_server.stub = RecordingAsyncVoiceStub()
+    gpt_server.update_frame(frame)
+    for request in create_requests():
+        await gpt_server.SetGpt(request, None)
+        await gpt_server.SendMotion(gpt_server_pb2.SendMotionRequest(), None)
+    return list(events)
+
+
+def compare(
+    name: str, thread_events: List[Tuple[str, Any]], aio_events: List[Tuple[str, Any]]
+) -> bool:
+    if thread_events == aio_events:
+        print(f"{name}: OK ({len(thread_events)} events)")
+        return True
+    print(f"{name}: NG")
+    for i in range(max(len(thread_events), len(aio_events))):
+        thread_event = thread_events[i] if i < len(thread_events) else None
+        aio_event = aio_events[i] if i < len(aio_events) else None
+        if thread_event != aio_event:
+            print(f"  thread: {thread_event}")
+            print(f"  aio:    {aio_event}")
+            break
+    return False
+
+
+def main() -> None:
+    # 発話ログを抑制する
+    stdout = sys.stdout
+    gpt_vision_publisher.ChatStreamAkariGrpc = RecordingChatStream
+    gpt_vision_aio_publisher.ChatStreamAkariGrpc = RecordingChatStream
+    gpt_vision_aio_publisher.AsyncChatStream = RecordingAsyncChatStream
+    frame = np.zeros((1080, 1920, 3), dtype=np.uint8)
+    cases = [
+        ("vision", False, ""),
+        (
+            "selective (without vision)",
+            True,
+            json.dumps({"vision": "0", "talk": "はい。元気です。"}, ensure_ascii=False),
+        ),
+        (
+            "selective (with vision)",
+            True,
+            json.dumps({"vision": "1", "talk": ""}, ensure_ascii=False),
+        ),
+    ]
+    success = True
+    for name, selective, judge_response in cases:
+        RecordingChatStream.judge_response = judge_response
+        sys.stdout = open(os.devnull, "w")
+        thread_events = run_thread_server(selective, frame)
+        aio_events = asyncio.run(run_aio_server(selective, frame))
+        sys.stdout = stdout
+        success = compare(name, thread_events, aio_events) and success
+    if not success:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,14 @@ import os
 import sys
 import threading
 from concurrent import futures
-from typing import Optional
+from typing import Any, Callable, List, Optional
 
 import cv2
 import grpc
 import numpy as np
 from akari_chatgpt_bot.lib.chat_akari_grpc import ChatStreamAkariGrpc
 from lib.akari_yolo_lib.oakd_tracking_yolo import OakdTrackingYolo
+from lib.process_stats import CpuUsageReporter, print_startup_time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "lib/grpc"))
 import gpt_server_pb2
@@ -18,8 +19,11 @@ import gpt_server_pb2_grpc
 import voice_server_pb2
 import voice_server_pb2_grpc
 
-messages = []
+SYSTEM_CONTENT = "チャットボットとしてロールプレイします。あかりという名前のカメラロボットとして振る舞ってください。"
+GREETING_TEXT = "画像の人の容姿や年齢、服装を見て挨拶の声がけをしてください。簡潔に答えてください。"
+
 chat_stream_akari_grpc = ChatStreamAkariGrpc()
+messages = [chat_stream_akari_grpc.create_message(SYSTEM_CONTENT, role="system")]
 voice_channel = grpc.insecure_channel("localhost:10002")
 voice_stub = voice_server_pb2_grpc.VoiceServerServiceStub(voice_channel)
 
@@ -33,8 +37,9 @@ class GptServer(gpt_server_pb2_grpc.GptServerServiceServicer):
 
     def __init__(self):
         global messages
-        content = "チャットボットとしてロールプレイします。あかりという名前のカメラロボットとして振る舞ってください。"
-        messages = [chat_stream_akari_grpc.create_message(content, role="system")]
+        messages = [
+            chat_stream_akari_grpc.create_message(SYSTEM_CONTENT, role="system")
+        ]
 
     def SetGpt(
         self, request: gpt_server_pb2.SetGptRequest(), context: grpc.ServicerContext
@@ -83,13 +88,20 @@ class GptServer(gpt_server_pb2_grpc.GptServerServiceServicer):
         return gpt_server_pb2.SendMotionReply(success=success)
 
 
-def send_greeting_vision_message(frame: np.ndarray, model: str = "gpt-4-turbo") -> None:
+def send_greeting_vision_message(
+    frame: np.ndarray,
+    model: str = "gpt-4-turbo",
+    history: Optional[List[Any]] = None,
+) -> str:
+    """
+    声がけを生成してvoice_serverに送る。
+    historyを指定した場合はその会話履歴を元に声がけし、モジュールの会話履歴には追加しない。
+    """
     global messages
-    text = "画像の人の容姿や年齢、服装を見て挨拶の声がけをしてください。簡潔に答えてください。"
-    tmp_messages = copy.deepcopy(messages)
+    tmp_messages = copy.deepcopy(messages if history is None else history)
     tmp_messages.append(
         chat_stream_akari_grpc.create_vision_message(
-            text=text,
+            text=GREETING_TEXT,
             image=frame,
             model=model,
             image_width=frame.shape[1],
@@ -97,7 +109,8 @@ def send_greeting_vision_message(frame: np.ndarray, model: str = "gpt-4-turbo")
         )
     )
     # 会話履歴にはデータ削減のため画像抜きのデータを残す
-    messages.append(chat_stream_akari_grpc.create_message(text))
+    if history is None:
+        messages.append(chat_stream_akari_grpc.create_message(GREETING_TEXT))
     response = ""
     for sentence in chat_stream_akari_grpc.chat(tmp_messages, model=model):
         print(f"Send voice: {sentence}")
@@ -109,7 +122,82 @@ def send_greeting_vision_message(frame: np.ndarray, model: str = "gpt-4-turbo")
         except BaseException:
             print("voice server send error")
         response += sentence
-    messages.append(chat_stream_akari_grpc.create_message(response, role="assistant"))
+    if history is None:
+        messages.append(
+            chat_stream_akari_grpc.create_message(response, role="assistant")
+        )
+    return response
+
+
+class GreetingTrigger(object):
+    """
+    トラッキング結果を監視し、一定距離以内に初めて近づいた人に声がけするクラス
+    """
+
+    def __init__(
+        self,
+        labels: Optional[List[str]] = None,
+        target: str = "person",
+        distance: float = GREETING_DISTANCE,
+        model: str = "gpt-4-turbo",
+        get_history: Optional[Callable[[], List[Any]]] = None,
+        on_greeting: Optional[Callable[[str, str], None]] = None,
+    ) -> None:
+        # labelsを指定した場合、target以外のラベルのtrackletは無視する。
+        self.labels = labels
+        # get_historyを指定した場合、その会話履歴を元に声がけし、
+        # 声がけの内容と返答をon_greetingに渡す。
+        self.get_history = get_history
+        self.on_greeting = on_greeting
+        self.target = target
+        self.distance = distance
+        self.model = model
+        self.greeting_person_id: Optional[int] = None
+
+    def is_target(self, tracklet: Any) -> bool:
+        if self.labels is None:
+            return True
+        return self.labels[tracklet.label] == self.target
+
+    def greet(self, frame: np.ndarray) -> None:
+        history = None
+        if self.get_history is not None:
+            history = self.get_history()
+        response = send_greeting_vision_message(frame, self.model, history)
+        if self.on_greeting is not None:
+            self.on_greeting(GREETING_TEXT, response)
+
+    def update(self, frame: Optional[np.ndarray], tracklets: Any) -> None:
+        if tracklets is None:
+            return
+        if self.greeting_person_id is not None:
+            tracking = False
+            for tracklet in tracklets:
+                if tracklet.id == self.greeting_person_id:
+                    tracking = True
+            if not tracking:
+                self.greeting_person_id = None
+            return
+        if frame is None:
+            return
+        for tracklet in tracklets:
+            if (
+                self.is_target(tracklet)
+                and tracklet.status.name == "TRACKED"
+                and tracklet.spatialCoordinates.z <= self.distance
+            ):
+                roi = tracklet.roi.denormalize(frame.shape[1], frame.shape[0])
+                x1 = int(roi.topLeft().x)
+                y1 = int(roi.topLeft().y)
+                x2 = int(roi.bottomRight().x)
+                y2 = int(roi.bottomRight().y)
+                person_frame = frame[y1:y2, x1:x2]
+                greeting_thread = threading.Thread(
+                    target=self.greet, args=(person_frame,)
+                )
+                greeting_thread.start()
+                self.greeting_person_id = tracklet.id
+                break
 
 
 def main() -> None:
@@ -147,6 +235,12 @@ def main() -> None:
     parser.add_argument(
         "--port", help="Gpt server port number", default="10001", type=str
     )
+    parser.add_argument(
+        "--stats_interval",
+        help="Interval in seconds to print cpu usage. 0 to disable",
+        default=0,
+        type=float,
+    )
     args = parser.parse_args()
     oakd_tracking_yolo = OakdTrackingYolo(
         config_path=args.config,
@@ -164,7 +258,10 @@ def main() -> None:
     server.add_insecure_port(args.ip + ":" + args.port)
     server.start()
     print(f"gpt_publisher start. port: {args.port}")
-    greeting_person_id: Optional[int] = None
+    greeting_trigger = GreetingTrigger()
+    if args.stats_interval > 0:
+        CpuUsageReporter(args.stats_interval).start()
+    first_frame = True
     end = False
     while not end:
         frame = None
@@ -174,33 +271,12 @@ def main() -> None:
         except BaseException:
             pass
         if tracklets is not None:
-            tracking = False
-            if greeting_person_id is not None:
-                for tracklet in tracklets:
-                    if tracklet.id == greeting_person_id:
-                        tracking = True
-                if not tracking:
-                    greeting_person_id = None
-            else:
-                for tracklet in tracklets:
-                    if (
-                        tracklet.status.name == "TRACKED"
-                        and tracklet.spatialCoordinates.z <= GREETING_DISTANCE
-                    ):
-                        roi = tracklet.roi.denormalize(frame.shape[1], frame.shape[0])
-                        x1 = int(roi.topLeft().x)
-                        y1 = int(roi.topLeft().y)
-                        x2 = int(roi.bottomRight().x)
-                        y2 = int(roi.bottomRight().y)
-                        person_frame = frame[y1:y2, x1:x2]
-                        greeting_thread = threading.Thread(
-                            target=send_greeting_vision_message, args=(person_frame,)
-                        )
-                        greeting_thread.start()
-                        greeting_person_id = tracklet.id
-                        break
+            greeting_trigger.update(frame, tracklets)
 
         if frame is not None:
+            if first_frame:
+                print_startup_time()
+                first_frame = False
             oakd_tracking_yolo.display_frame("nn", frame, tracklets)
         if cv2.waitKey(1) == ord("q"):
             end = True
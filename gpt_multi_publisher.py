@@ -0,0 +1,378 @@
+import argparse
+import copy
+import os
+import sys
+import threading
+from concurrent import futures
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import grpc
+import numpy as np
+from gpt_greeting_publisher import GptServer as TextGptServer
+from gpt_greeting_publisher import GreetingTrigger
+from gpt_vision_publisher import GptServer as VisionGptServer
+from gpt_vision_publisher import SelectiveGptServer
+from gpt_yolo_publisher import GptServer as YoloGptServer
+from gpt_yolo_publisher import YoloTracking
+from lib.process_stats import CpuUsageReporter, print_startup_time
+from lib.shared_frame import SharedFrameWriter, tracklets_to_metadata
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "lib/grpc"))
+import gpt_server_pb2
+import gpt_server_pb2_grpc
+
+# OAK-D LITEの視野角
+fov = 56.7
+
+# 表示ウィンドウでのキー入力と切り替え先モードの対応
+MODE_KEYS = {"v": "vision", "s": "selective", "y": "yolo"}
+GREETING_KEY = "g"
+
+
+class FrameBus(object):
+    """
+    OAK-Dから取得したframeとtrackletを複数のconsumerに配信するクラス
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.consumers: Dict[str, Callable[[np.ndarray, Any], None]] = {}
+        self.frame: Optional[np.ndarray] = None
+        self.tracklets: Any = None
+
+    def subscribe(
+        self, name: str, consumer: Callable[[np.ndarray, Any], None]
+    ) -> None:
+        with self.lock:
+            self.consumers[name] = consumer
+            frame = self.frame
+            tracklets = self.tracklets
+        # 途中から登録したconsumerにも最新のframeを渡しておく
+        if frame is not None:
+            consumer(frame, tracklets)
+
+    def unsubscribe(self, name: str) -> None:
+        with self.lock:
+            self.consumers.pop(name, None)
+
+    def is_subscribed(self, name: str) -> bool:
+        with self.lock:
+            return name in self.consumers
+
+    def publish(self, frame: np.ndarray, tracklets: Any) -> None:
+        with self.lock:
+            self.frame = frame
+            self.tracklets = tracklets
+            consumers = list(self.consumers.values())
+        for consumer in consumers:
+            try:
+                consumer(frame, tracklets)
+            except BaseException as e:
+                print(f"frame consumer error: {e}")
+
+
+class MultiModeGptServer(gpt_server_pb2_grpc.GptServerServiceServicer):
+    """
+    有効なモードのGptServerを保持し、選択中のモードへリクエストを振り分けるgrpcサーバ
+    """
+
+    def __init__(
+        self,
+        frame_bus: FrameBus,
+        servers: Dict[str, gpt_server_pb2_grpc.GptServerServiceServicer],
+        consumers: Dict[str, Callable[[np.ndarray, Any], None]],
+    ) -> None:
+        self.frame_bus = frame_bus
+        self.servers = servers
+        self.consumers = consumers
+        self.lock = threading.Lock()
+        self.mode: Optional[str] = None
+        # SetGpt処理中のモード毎のリクエスト数と、その間に届いた声がけ
+        # SetGptが会話履歴を書き換えている間は声がけを追加せず、リクエストが無くなってから追加する
+        self.history_lock = threading.Lock()
+        self.active_requests: Dict[str, int] = {mode: 0 for mode in servers}
+        self.pending_greetings: Dict[str, List[Any]] = {mode: [] for mode in servers}
+
+    def get_modes(self) -> List[str]:
+        return list(self.servers.keys())
+
+    def set_mode(self, mode: str) -> bool:
+        if mode not in self.servers:
+            print(f"mode {mode} is not enabled")
+            return False
+        with self.lock:
+            if self.mode == mode:
+                return True
+            if self.mode in self.consumers:
+                self.frame_bus.unsubscribe(self.mode)
+            self.mode = mode
+        if mode in self.consumers:
+            self.frame_bus.subscribe(mode, self.consumers[mode])
+        print(f"chat mode: {mode}")
+        return True
+
+    def get_server(self) -> gpt_server_pb2_grpc.GptServerServiceServicer:
+        with self.lock:
+            return self.servers[self.mode]
+
+    def get_mode_and_server(
+        self,
+    ) -> Tuple[str, gpt_server_pb2_grpc.GptServerServiceServicer]:
+        with self.lock:
+            return self.mode, self.servers[self.mode]
+
+    def get_messages(self) -> List[Any]:
+        with self.history_lock:
+            return copy.deepcopy(self.get_server().messages)
+
+    def add_greeting(self, text: str, response: str) -> None:
+        """
+        声がけの内容と返答を選択中のモードの会話履歴に追加する
+        SetGpt処理中の場合は、処理が終わってから追加する
+        """
+        mode, server = self.get_mode_and_server()
+        greeting = [
+            server.chat_stream_akari_grpc.create_message(text),
+            server.chat_stream_akari_grpc.create_message(response, role="assistant"),
+        ]
+        with self.history_lock:
+            if self.active_requests[mode] > 0:
+                self.pending_greetings[mode].extend(greeting)
+            else:
+                server.messages.extend(greeting)
+
+    def SetGpt(
+        self, request: gpt_server_pb2.SetGptRequest(), context: grpc.ServicerContext
+    ) -> gpt_server_pb2.SetGptReply:
+        mode, server = self.get_mode_and_server()
+        with self.history_lock:
+            self.active_requests[mode] += 1
+        try:
+            return server.SetGpt(request, context)
+        finally:
+            with self.history_lock:
+                self.active_requests[mode] -= 1
+                if (
+                    self.active_requests[mode] == 0
+                    and len(self.pending_greetings[mode]) > 0
+                ):
+                    server.messages.extend(self.pending_greetings[mode])
+                    self.pending_greetings[mode] = []
+
+    def SendMotion(
+        self, request: gpt_server_pb2.SendMotionRequest(), context: grpc.ServicerContext
+    ) -> gpt_server_pb2.SendMotionReply:
+        return self.get_server().SendMotion(request, context)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-m",
+        "--model",
+        help="Provide model name or model path for inference",
+        default="yolov7tiny_coco_416x416",
+        type=str,
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="Provide config path for inference",
+        default="json/yolov7tiny_coco_416x416.json",
+        type=str,
+    )
+    parser.add_argument(
+        "-f",
+        "--fps",
+        help="Camera frame fps. This should be smaller than nn inference fps",
+        default=8,
+        type=int,
+    )
+    parser.add_argument(
+        "-r",
+        "--robot_coordinate",
+        help="Convert object pos from camera coordinate to robot coordinate",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--ip", help="Gpt server ip address", default="127.0.0.1", type=str
+    )
+    parser.add_argument(
+        "--port", help="Gpt server port number", default="10001", type=str
+    )
+    parser.add_argument(
+        "-j",
+        "--judge_model",
+        help="LLM model name to judge whether to use vision",
+        default="claude-3-haiku-20240307",
+        type=str,
+    )
+    parser.add_argument(
+        "-v",
+        "--vision_model",
+        help="LLM model name for vision",
+        default="gpt-4-turbo",
+        type=str,
+    )
+    parser.add_argument(
+        "--vision",
+        help="Enable vision chat mode",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--selective",
+        help="Enable selective vision chat mode",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--yolo",
+        help="Enable yolo chat mode",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--greeting",
+        help="Enable greeting to approaching person",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shm_name",
+        help="Publish frames to shared memory with this name",
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--shm_slots",
+        help="Number of frames kept in shared memory ring buffer",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--stats_interval",
+        help="Interval in seconds to print cpu usage. 0 to disable",
+        default=0,
+        type=float,
+    )
+    args = parser.parse_args()
+    if not (args.vision or args.selective or args.yolo or args.greeting):
+        args.vision = True
+    # 全モードで1つのOAK-Dパイプラインを共有する
+    yolo_tracking = YoloTracking(
+        config_path=args.config,
+        model_path=args.model,
+        fps=args.fps,
+        fov=fov,
+        robot_coordinate=args.robot_coordinate,
+    )
+    frame_bus = FrameBus()
+    servers: Dict[str, gpt_server_pb2_grpc.GptServerServiceServicer] = {}
+    consumers: Dict[str, Callable[[np.ndarray, Any], None]] = {}
+    if args.vision:
+        vision_server = VisionGptServer(vision_model=args.vision_model)
+        servers["vision"] = vision_server
+        consumers["vision"] = lambda frame, tracklets: vision_server.update_frame(
+            frame
+        )
+    if args.selective:
+        selective_server = SelectiveGptServer(
+            judge_model=args.judge_model, vision_model=args.vision_model
+        )
+        servers["selective"] = selective_server
+        consumers["selective"] = (
+            lambda frame, tracklets: selective_server.update_frame(frame)
+        )
+    if args.yolo:
+        servers["yolo"] = YoloGptServer(yolo_tracking)
+        consumers["yolo"] = lambda frame, tracklets: yolo_tracking.set_tracklet(
+            tracklets
+        )
+    if len(servers) == 0:
+        # 声がけのみ有効な場合は画像を使わない会話を行う
+        servers["text"] = TextGptServer()
+    gpt_server = MultiModeGptServer(frame_bus, servers, consumers)
+    gpt_server.set_mode(gpt_server.get_modes()[0])
+    greeting_trigger: Optional[GreetingTrigger] = None
+    if args.greeting:
+        if "text" in servers:
+            # 声がけのみの場合はgpt_greeting_publisherの会話履歴を共有する
+            greeting_trigger = GreetingTrigger(
+                labels=yolo_tracking.labels, model=args.vision_model
+            )
+        else:
+            # 声がけを選択中のモードの会話履歴に追加し、その後の会話に引き継ぐ
+            greeting_trigger = GreetingTrigger(
+                labels=yolo_tracking.labels,
+                model=args.vision_model,
+                get_history=gpt_server.get_messages,
+                on_greeting=gpt_server.add_greeting,
+            )
+        frame_bus.subscribe("greeting", greeting_trigger.update)
+    shm_name: Optional[str] = args.shm_name
+    if shm_name is not None:
+        # 画像の取得前に共有メモリ名が使用可能か確認し、使えない場合は共有メモリ無しで起動する
+        try:
+            SharedFrameWriter.reclaim(shm_name)
+        except FileExistsError as e:
+            print(f"shared memory error: {e}. shared memory is disabled.")
+            shm_name = None
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    gpt_server_pb2_grpc.add_GptServerServiceServicer_to_server(gpt_server, server)
+    server.add_insecure_port(args.ip + ":" + args.port)
+    server.start()
+    print(f"gpt_publisher start. port: {args.port}")
+    print(f"enabled modes: {gpt_server.get_modes()}")
+    if args.stats_interval > 0:
+        CpuUsageReporter(args.stats_interval).start()
+    shared_frame_writer: Optional[SharedFrameWriter] = None
+    first_frame = True
+    end = False
+    while not end:
+        frame = None
+        tracklets = None
+        try:
+            frame, detections, tracklets = yolo_tracking.oakd_tracking_yolo.get_frame()
+        except BaseException:
+            pass
+        if frame is not None:
+            if first_frame:
+                print_startup_time()
+                first_frame = False
+                if shm_name is not None:
+                    # 他プロセスから画像を参照できるよう共有メモリに書き込む
+                    try:
+                        shared_frame_writer = SharedFrameWriter(
+                            frame.shape, name=shm_name, n_slots=args.shm_slots
+                        )
+                    except FileExistsError as e:
+                        print(f"shared memory error: {e}. shared memory is disabled.")
+                if shared_frame_writer is not None:
+                    frame_bus.subscribe(
+                        "shared_memory",
+                        lambda frame, tracklets: shared_frame_writer.write(
+                            frame,
+                            tracklets_to_metadata(tracklets, yolo_tracking.labels),
+                        ),
+                    )
+            frame_bus.publish(frame, tracklets)
+            yolo_tracking.oakd_tracking_yolo.display_frame("nn", frame, tracklets)
+        key = cv2.waitKey(1)
+        if key == ord("q"):
+            end = True
+            break
+        for mode_key, mode in MODE_KEYS.items():
+            if key == ord(mode_key):
+                gpt_server.set_mode(mode)
+        if key == ord(GREETING_KEY) and greeting_trigger is not None:
+            if frame_bus.is_subscribed("greeting"):
+                frame_bus.unsubscribe("greeting")
+                print("greeting: off")
+            else:
+                frame_bus.subscribe("greeting", greeting_trigger.update)
+                print("greeting: on")
+    if shared_frame_writer is not None:
+        frame_bus.unsubscribe("shared_memory")
+        shared_frame_writer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,555 @@
+import argparse
+import asyncio
+import copy
+import functools
+import json
+import os
+import sys
+import threading
+from concurrent import futures
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+import anthropic
+import cv2
+import depthai as dai
+import grpc
+import numpy as np
+import openai
+from akari_chatgpt_bot.lib.chat_akari_grpc import ChatStreamAkariGrpc
+from gpt_stream_parser import force_parse_json
+from gpt_vision_publisher import SYSTEM_CONTENT, create_camera_pipeline
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "lib/grpc"))
+import gpt_server_pb2
+import gpt_server_pb2_grpc
+import motion_server_pb2
+import motion_server_pb2_grpc
+import voice_server_pb2
+import voice_server_pb2_grpc
+
+
+class AsyncChatStream(object):
+    """
+    OpenAI,AnthropicのLLMにasyncクライアントでリクエストし、返答を一文ずつ返すクラス
+    プロンプトを追加しないchatのみを扱い、モーション付きの返答はChatStreamAkariGrpcで生成する。
+    """
+
+    def __init__(
+        self,
+        last_char: List[str],
+        motion_address: str = "localhost:50055",
+    ) -> None:
+        self.last_char = last_char
+        self._openai_client: Optional[openai.AsyncOpenAI] = None
+        self._anthropic_client: Optional[anthropic.AsyncAnthropic] = None
+        motion_channel = grpc.aio.insecure_channel(motion_address)
+        self.motion_stub = motion_server_pb2_grpc.MotionServerServiceStub(
+            motion_channel
+        )
+
+    @property
+    def openai_client(self) -> openai.AsyncOpenAI:
+        if self._openai_client is None:
+            self._openai_client = openai.AsyncOpenAI()
+        return self._openai_client
+
+    @property
+    def anthropic_client(self) -> anthropic.AsyncAnthropic:
+        if self._anthropic_client is None:
+            self._anthropic_client = anthropic.AsyncAnthropic()
+        return self._anthropic_client
+
+    @staticmethod
+    def supports(model: str) -> bool:
+        return model.startswith("gpt") or model.startswith("claude")
+
+    async def stream_openai(
+        self, messages: List[Any], model: str, temperature: float
+    ) -> AsyncIterator[str]:
+        result = await self.openai_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+        )
+        async for chunk in result:
+            if len(chunk.choices) == 0:
+                continue
+            text = chunk.choices[0].delta.content
+            if text is not None:
+                yield text
+
+    async def stream_anthropic(
+        self, messages: List[Any], model: str, temperature: float
+    ) -> AsyncIterator[str]:
+        system_message = ""
+        user_messages = []
+        for message in messages:
+            if message["role"] == "system":
+                system_message = message["content"]
+            else:
+                user_messages.append(message)
+        async with self.anthropic_client.messages.stream(
+            model=model,
+            max_tokens=1000,
+            temperature=temperature,
+            messages=user_messages,
+            system=system_message,
+        ) as result:
+            async for text in result.text_stream:
+                if text is not None:
+                    yield text
+
+    def stream(
+        self, messages: List[Any], model: str, temperature: float
+    ) -> AsyncIterator[str]:
+        if model.startswith("claude"):
+            return self.stream_anthropic(messages, model, temperature)
+        return self.stream_openai(messages, model, temperature)
+
+    def find_sentence_end(self, text: str) -> int:
+        positions = [
+            pos for pos in (text.find(char) for char in self.last_char) if pos >= 0
+        ]
+        if len(positions) == 0:
+            return -1
+        return min(positions)
+
+    async def chat(
+        self, messages: List[Any], model: str, temperature: float = 0.7
+    ) -> AsyncIterator[str]:
+        response = ""
+        async for text in self.stream(messages, model, temperature):
+            response += text
+            # 区切り文字が来るたびに一文ずつ返す
+            pos = self.find_sentence_end(response)
+            while pos >= 0:
+                yield response[: pos + 1]
+                response = response[pos + 1 :]
+                pos = self.find_sentence_end(response)
+        if len(response) > 0:
+            yield response
+
+    async def send_motion(self, name: str) -> bool:
+        try:
+            await self.motion_stub.SetMotion(
+                motion_server_pb2.SetMotionRequest(
+                    name=name, priority=3, repeat=False, clear=True
+                )
+            )
+        except Exception:
+            print("send motion error!")
+            return False
+        return True
+
+
+class AioGptServer(gpt_server_pb2_grpc.GptServerServiceServicer):
+    """
+    chatGPTにtextを送信し、返答をvoice_serverに送るgrpc.aioサーバ
+    """
+
+    def __init__(
+        self,
+        vision_model: str = "gpt-4-turbo",
+        chat_model: Optional[str] = None,
+        max_streams: int = 10,
+        executor_workers: int = 4,
+        voice_address: str = "localhost:10002",
+        motion_address: str = "localhost:50055",
+    ) -> None:
+        # voice_server,motion_serverへの送信はasyncのstubで行う。
+        # ただしchat_and_motionで予約したモーションはChatStreamAkariGrpcから送信する。
+        voice_channel = grpc.aio.insecure_channel(voice_address)
+        self.stub = voice_server_pb2_grpc.VoiceServerServiceStub(voice_channel)
+        self.chat_stream_akari_grpc = ChatStreamAkariGrpc()
+        self.messages = [
+            self.chat_stream_akari_grpc.create_message(SYSTEM_CONTENT, role="system")
+        ]
+        self.vision_model = vision_model
+        self.chat_model = chat_model
+        self.async_chat_stream = AsyncChatStream(
+            self.chat_stream_akari_grpc.last_char, motion_address=motion_address
+        )
+        # 同時に処理するLLMのストリーム数の上限
+        self.semaphore = asyncio.Semaphore(max_streams)
+        # asyncクライアントの無い処理を実行するスレッドプール。
+        # chat_and_motionとasyncクライアントの無いLLMのストリームはそれぞれ1スレッドを専有するため、
+        # max_streamsに加えて画像のエンコード用にexecutor_workersの分を確保する。
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=max_streams + executor_workers
+        )
+        self.frame: Optional[np.ndarray] = None
+        self.frame_lock = threading.Lock()
+
+    def update_frame(self, frame: np.ndarray) -> None:
+        with self.frame_lock:
+            self.frame = frame
+
+    def get_frame(self) -> Optional[np.ndarray]:
+        with self.frame_lock:
+            return self.frame
+
+    async def run_in_executor(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def iterate_in_executor(self, generator: Iterator[str]) -> AsyncIterator[str]:
+        sentinel = object()
+        while True:
+            sentence = await self.run_in_executor(next, generator, sentinel)
+            if sentence is sentinel:
+                break
+            yield sentence
+
+    async def chat(self, messages: List[Any], model: str) -> AsyncIterator[str]:
+        if AsyncChatStream.supports(model):
+            stream = self.async_chat_stream.chat(messages, model=model)
+        else:
+            stream = self.iterate_in_executor(
+                self.chat_stream_akari_grpc.chat(messages, model=model)
+            )
+        async for sentence in stream:
+            yield sentence
+
+    def chat_and_motion(
+        self, messages: List[Any], model: Optional[str], short_response: bool = False
+    ) -> AsyncIterator[str]:
+        # プロンプトとモーションの選択が同期版と同じになるよう、ChatStreamAkariGrpcをそのまま使う
+        # modelを指定しない場合はChatStreamAkariGrpcのデフォルトのモデルを使う
+        kwargs: Dict[str, Any] = {"short_response": short_response}
+        if model is not None:
+            kwargs["model"] = model
+        return self.iterate_in_executor(
+            self.chat_stream_akari_grpc.chat_and_motion(messages, **kwargs)
+        )
+
+    async def send_voice(self, sentence: str) -> None:
+        print(f"Send voice: {sentence}")
+        try:
+            await self.stub.SetText(voice_server_pb2.SetTextRequest(text=sentence))
+        except Exception:
+            print("voice server send error")
+
+    async def send_reserved_motion(self) -> bool:
+        return await self.run_in_executor(
+            self.chat_stream_akari_grpc.send_reserved_motion
+        )
+
+    async def SetGpt(
+        self,
+        request: gpt_server_pb2.SetGptRequest(),
+        context: grpc.aio.ServicerContext,
+    ) -> gpt_server_pb2.SetGptReply:
+        response = ""
+        is_finish = True
+        if request.HasField("is_finish"):
+            is_finish = request.is_finish
+        if len(request.text) < 2:
+            return gpt_server_pb2.SetGptReply(success=True)
+        print(f"Receive: {request.text}")
+        if is_finish:
+            content = f"{request.text}。一文で簡潔に答えてください。"
+        else:
+            content = f"「{request.text}。"
+        tmp_messages = copy.deepcopy(self.messages)
+        async with self.semaphore:
+            if is_finish:
+                # 画像のエンコードはイベントループを止めないようスレッドプールで行う
+                tmp_messages.append(
+                    await self.run_in_executor(
+                        self.chat_stream_akari_grpc.create_vision_message,
+                        content,
+                        self.get_frame(),
+                        model=self.vision_model,
+                    )
+                )
+                async for sentence in self.chat(tmp_messages, model=self.vision_model):
+                    await self.send_voice(sentence)
+                    response += sentence
+            else:
+                tmp_messages.append(self.chat_stream_akari_grpc.create_message(content))
+                async for sentence in self.chat_and_motion(
+                    tmp_messages, model=self.chat_model, short_response=True
+                ):
+                    await self.send_voice(sentence)
+                    response += sentence
+        return gpt_server_pb2.SetGptReply(success=True)
+
+    async def SendMotion(
+        self,
+        request: gpt_server_pb2.SendMotionRequest(),
+        context: grpc.aio.ServicerContext,
+    ) -> gpt_server_pb2.SendMotionReply:
+        success = await self.send_reserved_motion()
+        return gpt_server_pb2.SendMotionReply(success=success)
+
+
+class AioSelectiveGptServer(AioGptServer):
+    def __init__(
+        self,
+        judge_model: str = "claude-3-haiku-20240307",
+        vision_model: str = "claude-3-haiku-20240307",
+        chat_model: str = "claude-3-haiku-20240307",
+        max_streams: int = 10,
+        executor_workers: int = 4,
+        voice_address: str = "localhost:10002",
+        motion_address: str = "localhost:50055",
+    ) -> None:
+        super().__init__(
+            vision_model,
+            chat_model,
+            max_streams,
+            executor_workers,
+            voice_address,
+            motion_address,
+        )
+        self.judge_model = judge_model
+        self.sent_motion = True  # モーションを送信し終わったか
+
+    async def selective_vision_chat_anthropic(
+        self, messages, content, frame, temperature=0.7
+    ) -> str:
+        response = ""
+        use_vision = False
+        judge_messages = copy.deepcopy(messages)
+        judge_content = f'「{content}」に対して、画像を見て回答した方がいいか、見ないで回答した方がいいかを決定し、下記のJSON形式で出力して下さい。{{"vision": "画像を見る場合は "1" 、見ない場合は "0" string型で回答", "talk": "画像を見る場合は空白、見ない場合は回答のテキストを出力"}}'
+        judge_message = self.chat_stream_akari_grpc.create_message(judge_content)
+        judge_messages.append(judge_message)
+
+        # Visionを使うかどうか判定。使わない場合はそのまま発話
+        full_response = ""
+        real_time_response = ""
+        sentence_index = 0
+        async for text in self.async_chat_stream.stream_anthropic(
+            judge_messages, self.judge_model, temperature
+        ):
+            full_response += text
+            real_time_response += text
+            try:
+                data_json = json.loads(full_response)
+                found_last_char = False
+                for char in self.chat_stream_akari_grpc.last_char:
+                    if real_time_response[-1].find(char) >= 0:
+                        found_last_char = True
+                if not found_last_char:
+                    data_json["talk"] = data_json["talk"] + "。"
+            except BaseException:
+                data_json = force_parse_json(full_response)
+            if data_json is not None:
+                if "vision" in data_json:
+                    if data_json["vision"] == "1":
+                        use_vision = True
+                    if "talk" in data_json:
+                        real_time_response = str(data_json["talk"])
+                        for char in self.chat_stream_akari_grpc.last_char:
+                            pos = real_time_response[sentence_index:].find(char)
+                            if pos >= 0:
+                                sentence = real_time_response[
+                                    sentence_index : sentence_index + pos + 1
+                                ]
+                                sentence_index += pos + 1
+                                response += sentence
+                                if not use_vision:
+                                    if not self.sent_motion:
+                                        self.sent_motion = (
+                                            await self.send_reserved_motion()
+                                        )
+                                    await self.send_voice(sentence)
+        if use_vision:
+            try:
+                await self.stub.SetText(voice_server_pb2.SetTextRequest(text="えーと"))
+            except Exception:
+                print("voice server send error")
+            await self.async_chat_stream.send_motion("lookup")
+            # Visionを使う場合は再度質問
+            vision_messages = copy.deepcopy(messages)
+            vision_message = await self.run_in_executor(
+                self.chat_stream_akari_grpc.create_vision_message,
+                text=content,
+                image=frame,
+                model=self.vision_model,
+            )
+            vision_messages.append(vision_message)
+            response = ""
+            async for sentence in self.chat(vision_messages, model=self.vision_model):
+                if not self.sent_motion:
+                    self.sent_motion = await self.send_reserved_motion()
+                await self.send_voice(sentence)
+                response += sentence
+        return response
+
+    async def SetGpt(
+        self,
+        request: gpt_server_pb2.SetGptRequest(),
+        context: grpc.aio.ServicerContext,
+    ) -> gpt_server_pb2.SetGptReply:
+        response = ""
+        is_finish = True
+        if request.HasField("is_finish"):
+            is_finish = request.is_finish
+        if len(request.text) < 2:
+            return gpt_server_pb2.SetGptReply(success=True)
+        print(f"Receive: {request.text}")
+        if is_finish:
+            content = f"{request.text}。。一文で簡潔に答えてください。"
+        else:
+            content = f"「{request.text}。"
+        tmp_messages = copy.deepcopy(self.messages)
+        async with self.semaphore:
+            if is_finish:
+                response += await self.selective_vision_chat_anthropic(
+                    tmp_messages,
+                    content,
+                    self.get_frame(),
+                )
+            else:
+                tmp_messages.append(self.chat_stream_akari_grpc.create_message(content))
+                self.sent_motion = False
+                async for sentence in self.chat_and_motion(
+                    tmp_messages, model=self.chat_model, short_response=True
+                ):
+                    response += sentence
+        return gpt_server_pb2.SetGptReply(success=True)
+
+    async def SendMotion(
+        self,
+        request: gpt_server_pb2.SendMotionRequest(),
+        context: grpc.aio.ServicerContext,
+    ) -> gpt_server_pb2.SendMotionReply:
+        """音声認識からの送信司令は無視する。"""
+        return gpt_server_pb2.SendMotionReply(success=True)
+
+
+async def serve(
+    gpt_server: AioGptServer,
+    ip: str,
+    port: str,
+    max_rpcs: Optional[int] = None,
+) -> grpc.aio.Server:
+    # max_rpcsを超えたリクエストはRESOURCE_EXHAUSTEDで即座に拒否する
+    server = grpc.aio.server(maximum_concurrent_rpcs=max_rpcs)
+    gpt_server_pb2_grpc.add_GptServerServiceServicer_to_server(gpt_server, server)
+    server.add_insecure_port(ip + ":" + port)
+    await server.start()
+    return server
+
+
+def capture_loop(gpt_server: AioGptServer) -> None:
+    """
+    OAK-Dから画像を取得し、gpt_serverに渡すループ。OpenCVの表示を行うためメインスレッドで実行する。
+    """
+    pipeline = create_camera_pipeline()
+    while True:
+        frame = None
+        with dai.Device(pipeline) as device:
+            video = device.getOutputQueue(name="video", maxSize=1, blocking=False)  # type: ignore
+            while True:
+                videoIn = video.get()
+                frame = videoIn.getCvFrame()
+                if frame is not None:
+                    gpt_server.update_frame(frame)
+                    cv2.imshow("video", cv2.resize(frame, (640, 360)))
+                if cv2.waitKey(1) == ord("q"):
+                    break
+            device.close()
+
+
+async def async_main(
+    args: argparse.Namespace, on_start: Callable[[AioGptServer], None]
+) -> None:
+    if args.selective:
+        gpt_server: AioGptServer = AioSelectiveGptServer(
+            judge_model=args.judge_model,
+            vision_model=args.vision_model,
+            max_streams=args.max_streams,
+            executor_workers=args.executor_workers,
+            motion_address=args.robot_ip + ":" + args.robot_port,
+        )
+    else:
+        gpt_server = AioGptServer(
+            vision_model=args.vision_model,
+            max_streams=args.max_streams,
+            executor_workers=args.executor_workers,
+            motion_address=args.robot_ip + ":" + args.robot_port,
+        )
+    server = await serve(gpt_server, args.ip, args.port, args.max_rpcs)
+    print(f"gpt_publisher start. port: {args.port}")
+    on_start(gpt_server)
+    await server.wait_for_termination()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--ip", help="Gpt server ip address", default="127.0.0.1", type=str
+    )
+    parser.add_argument(
+        "--port", help="Gpt server port number", default="10001", type=str
+    )
+    parser.add_argument(
+        "-j",
+        "--judge_model",
+        help="LLM model name to judge whether to use vision",
+        default="claude-3-haiku-20240307",
+        type=str,
+    )
+    parser.add_argument(
+        "-v",
+        "--vision_model",
+        help="LLM model name for vision",
+        default="gpt-4-turbo",
+        type=str,
+    )
+    parser.add_argument(
+        "--selective",
+        help="Use selective vision bot",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max_streams",
+        help="Max number of LLM streams processed at the same time",
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        "--max_rpcs",
+        help="Max number of concurrent rpcs. Requests over this are rejected",
+        default=20,
+        type=int,
+    )
+    parser.add_argument(
+        "--executor_workers",
+        help="Number of threads for image encoding, added to max_streams threads "
+        "for LLM streams without async client",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--robot_ip", help="Motion server ip address", default="127.0.0.1", type=str
+    )
+    parser.add_argument(
+        "--robot_port", help="Motion server port number", default="50055", type=str
+    )
+    args = parser.parse_args()
+    # grpc.aioのイベントループは別スレッドで実行し、カメラの取得と表示はメインスレッドで行う
+    gpt_servers: List[AioGptServer] = []
+    started = threading.Event()
+
+    def on_start(gpt_server: AioGptServer) -> None:
+        gpt_servers.append(gpt_server)
+        started.set()
+
+    server_thread = threading.Thread(
+        target=lambda: asyncio.run(async_main(args, on_start)), daemon=True
+    )
+    server_thread.start()
+    while not started.wait(0.1):
+        if not server_thread.is_alive():
+            return
+    capture_loop(gpt_servers[0])
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ import grpc
 import numpy as np
 from akari_chatgpt_bot.lib.chat_akari_grpc import ChatStreamAkariGrpc
 from gpt_stream_parser import force_parse_json
+from lib.process_stats import CpuUsageReporter, print_startup_time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "lib/grpc"))
 import gpt_server_pb2
@@ -23,6 +24,8 @@ import voice_server_pb2_grpc
 # OAK-D LITEの視野角
 fov = 56.7
 
+SYSTEM_CONTENT = "チャットボットとしてロールプレイします。あかりという名前のカメラロボットとして振る舞ってください。"
+
 
 class GptServer(gpt_server_pb2_grpc.GptServerServiceServicer):
     """
@@ -33,9 +36,8 @@ class GptServer(gpt_server_pb2_grpc.GptServerServiceServicer):
         voice_channel = grpc.insecure_channel("localhost:10002")
         self.stub = voice_server_pb2_grpc.VoiceServerServiceStub(voice_channel)
         self.chat_stream_akari_grpc = ChatStreamAkariGrpc()
-        content = "チャットボットとしてロールプレイします。あかりという名前のカメラロボットとして振る舞ってください。"
         self.messages = [
-            self.chat_stream_akari_grpc.create_message(content, role="system")
+            self.chat_stream_akari_grpc.create_message(SYSTEM_CONTENT, role="system")
         ]
         self.vision_model = vision_model
 
@@ -255,6 +257,24 @@ class SelectiveGptServer(GptServer):
         return gpt_server_pb2.SendMotionReply(success=True)
 
 
+def create_camera_pipeline() -> dai.Pipeline:
+    """
+    OAK-Dのカメラ画像を"video"ストリームで出力するパイプラインを作成する
+    """
+    pipeline = dai.Pipeline()
+    cam_rgb = pipeline.create(dai.node.ColorCamera)
+    xout_video = pipeline.create(dai.node.XLinkOut)
+    cam_rgb.setBoardSocket(dai.CameraBoardSocket.RGB)
+    cam_rgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_1080_P)
+    cam_rgb.setVideoSize(1920, 1080)
+    cam_rgb.setFps(10)
+    cam_rgb.video.link(xout_video.input)
+    xout_video.input.setBlocking(False)
+    xout_video.input.setQueueSize(1)
+    xout_video.setStreamName("video")
+    return pipeline
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -282,6 +302,12 @@ def main() -> None:
         help="Use selective vision bot",
         action="store_true",
     )
+    parser.add_argument(
+        "--stats_interval",
+        help="Interval in seconds to print cpu usage. 0 to disable",
+        default=0,
+        type=float,
+    )
     args = parser.parse_args()
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
     if args.selective:
@@ -293,20 +319,12 @@ def main() -> None:
     gpt_server_pb2_grpc.add_GptServerServiceServicer_to_server(gpt_server, server)
     server.add_insecure_port(args.ip + ":" + args.port)
     server.start()
-    # OAK-Dのパイプライン作成
-    pipeline = dai.Pipeline()
-    cam_rgb = pipeline.create(dai.node.ColorCamera)
-    xout_video = pipeline.create(dai.node.XLinkOut)
-    cam_rgb.setBoardSocket(dai.CameraBoardSocket.RGB)
-    cam_rgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_1080_P)
-    cam_rgb.setVideoSize(1920, 1080)
-    cam_rgb.setFps(10)
-    cam_rgb.video.link(xout_video.input)
-    xout_video.input.setBlocking(False)
-    xout_video.input.setQueueSize(1)
-    xout_video.setStreamName("video")
+    pipeline = create_camera_pipeline()
 
     print(f"gpt_publisher start. port: {args.port}")
+    if args.stats_interval > 0:
+        CpuUsageReporter(args.stats_interval).start()
+    first_frame = True
     while True:
         frame = None
         with dai.Device(pipeline) as device:
@@ -315,6 +333,9 @@ def main() -> None:
                 videoIn = video.get()
                 frame = videoIn.getCvFrame()
                 if frame is not None:
+                    if first_frame:
+                        print_startup_time()
+                        first_frame = False
                     gpt_server.update_frame(frame)
                     cv2.imshow("video", cv2.resize(frame, (640, 360)))
                 if cv2.waitKey(1) == ord("q"):
@@ -9,6 +9,7 @@ import cv2
 import grpc
 from akari_chatgpt_bot.lib.chat_akari_grpc import ChatStreamAkariGrpc
 from lib.akari_yolo_lib.oakd_tracking_yolo import OakdTrackingYolo
+from lib.process_stats import CpuUsageReporter, print_startup_time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "lib/grpc"))
 import gpt_server_pb2
@@ -27,9 +28,14 @@ class YoloTracking(object):
         model_path: str,
         fps: int,
         fov: float,
+        robot_coordinate: bool = False,
     ) -> None:
         self.oakd_tracking_yolo = OakdTrackingYolo(
-            config_path=config_path, model_path=model_path, fps=fps, fov=fov
+            config_path=config_path,
+            model_path=model_path,
+            fps=fps,
+            fov=fov,
+            robot_coordinate=robot_coordinate,
         )
         self.tracklets = []
         self.labels = self.oakd_tracking_yolo.get_labels()
@@ -154,6 +160,12 @@ def main() -> None:
     parser.add_argument(
         "--port", help="Gpt server port number", default="10001", type=str
     )
+    parser.add_argument(
+        "--stats_interval",
+        help="Interval in seconds to print cpu usage. 0 to disable",
+        default=0,
+        type=float,
+    )
     args = parser.parse_args()
     yolo_tracking = YoloTracking(
         config_path=args.config,
@@ -168,6 +180,9 @@ def main() -> None:
     server.add_insecure_port(args.ip + ":" + args.port)
     server.start()
     print(f"gpt_publisher start. port: {args.port}")
+    if args.stats_interval > 0:
+        CpuUsageReporter(args.stats_interval).start()
+    first_frame = True
     end = False
     while not end:
         frame = None
@@ -179,6 +194,9 @@ def main() -> None:
         if tracklets is not None:
             yolo_tracking.set_tracklet(tracklets)
         if frame is not None:
+            if first_frame:
+                print_startup_time()
+                first_frame = False
             yolo_tracking.oakd_tracking_yolo.display_frame(
                 "nn", frame, yolo_tracking.tracklets
             )
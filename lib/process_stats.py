@@ -0,0 +1,63 @@
+import os
+import resource
+import threading
+import time
+
+# /procが読めない環境ではこのモジュールのimport時刻をプロセスの起動時刻とみなす
+_IMPORT_TIME = time.time()
+
+
+def get_process_start_time() -> float:
+    """
+    プロセスの起動時刻(UNIX時間)を返す。
+    import前のインタプリタの起動やモジュールの読み込みにかかった時間も含めて計測するため、/procから取得する。
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            stat = f.read()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        # プロセス名に空白が含まれる場合があるため、")"以降を分割する。starttimeは22番目の項目。
+        start_ticks = int(stat[stat.rindex(")") + 2 :].split()[19])
+        elapsed = uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+        return time.time() - elapsed
+    except (OSError, ValueError, IndexError):
+        return _IMPORT_TIME
+
+
+def print_startup_time() -> None:
+    print(f"startup time: {time.time() - get_process_start_time():.2f}s")
+
+
+def cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class CpuUsageReporter(object):
+    """
+    プロセス全体のCPU使用率と最大メモリ使用量を一定間隔で表示するクラス
+    """
+
+    def __init__(self, interval: float = 10.0) -> None:
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def run(self) -> None:
+        last_wall = time.time()
+        last_cpu = cpu_time()
+        while not self.stop_event.wait(self.interval):
+            now_wall = time.time()
+            now_cpu = cpu_time()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            # LinuxではKB単位
+            print(
+                f"cpu: {(now_cpu - last_cpu) / (now_wall - last_wall) * 100:.1f}% "
+                f"(total {now_cpu:.1f}s), max rss: {usage.ru_maxrss / 1024:.1f}MB"
+            )
+            last_wall = now_wall
+            last_cpu = now_cpu
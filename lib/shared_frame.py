@@ -0,0 +1,363 @@
+import json
+import os
+import struct
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+# 共有メモリ全体のヘッダ: magic, スロット数, スロット毎の画像領域サイズ, メタデータ領域サイズ, 最新シーケンス番号,
+# 書き込み側のPID, 世代(書き込み側が共有メモリを作成する毎に変わる値)
+HEADER_FORMAT = "<8sIQIQIQ"
+HEADER_SIZE = 64
+LATEST_SEQ_OFFSET = 24
+# スロット毎のヘッダ: 書き込み開始seq, 書き込み完了seq, タイムスタンプ, 高さ, 幅, チャンネル数, メタデータ長
+SLOT_HEADER_FORMAT = "<QQdIIII"
+SLOT_HEADER_SIZE = 64
+MAGIC = b"AKFRAME1"
+DEFAULT_NAME = "akari_frame"
+
+
+def _align(size: int, alignment: int = 64) -> int:
+    return (size + alignment - 1) // alignment * alignment
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # 他ユーザのプロセスとして存在している
+        return True
+    return True
+
+
+def _read_header(shm: shared_memory.SharedMemory) -> tuple:
+    return struct.unpack_from(HEADER_FORMAT, shm.buf, 0)
+
+
+def _open_untracked(name: str) -> shared_memory.SharedMemory:
+    """
+    既存の共有メモリを、このプロセスの終了時にunlinkされないように開く
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+    return shm
+
+
+def tracklets_to_metadata(
+    tracklets: Any, labels: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """
+    OAK-Dのtrackletを共有メモリに書き込めるdictに変換する
+    """
+    results = []
+    if tracklets is not None:
+        for tracklet in tracklets:
+            roi = tracklet.roi
+            results.append(
+                {
+                    "id": tracklet.id,
+                    "label": labels[tracklet.label]
+                    if labels is not None
+                    else tracklet.label,
+                    "status": tracklet.status.name,
+                    "roi": [
+                        roi.topLeft().x,
+                        roi.topLeft().y,
+                        roi.bottomRight().x,
+                        roi.bottomRight().y,
+                    ],
+                    "x": tracklet.spatialCoordinates.x,
+                    "y": tracklet.spatialCoordinates.y,
+                    "z": tracklet.spatialCoordinates.z,
+                }
+            )
+    return {"tracklets": results}
+
+
+class SharedFrame(NamedTuple):
+    seq: int
+    generation: int
+    timestamp: float
+    frame: np.ndarray
+    metadata: Dict[str, Any]
+
+
+class SharedFrameWriter(object):
+    """
+    画像とメタデータを共有メモリのリングバッファに書き込むクラス
+    書き込みは1プロセスのみから行うこと。
+    """
+
+    def __init__(
+        self,
+        shape: tuple,
+        name: str = DEFAULT_NAME,
+        n_slots: int = 4,
+        meta_size: int = 16384,
+    ) -> None:
+        self.n_slots = n_slots
+        self.data_size = _align(int(np.prod(shape)))
+        self.meta_size = _align(meta_size)
+        self.slot_size = SLOT_HEADER_SIZE + self.meta_size + self.data_size
+        size = HEADER_SIZE + self.slot_size * n_slots
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            self.reclaim(name)
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.buf = self.shm.buf
+        self.seq = 0
+        self.generation = time.time_ns()
+        struct.pack_into(
+            HEADER_FORMAT,
+            self.buf,
+            0,
+            MAGIC,
+            n_slots,
+            self.data_size,
+            self.meta_size,
+            self.seq,
+            os.getpid(),
+            self.generation,
+        )
+
+    @staticmethod
+    def reclaim(name: str) -> None:
+        """
+        前回異常終了した書き込み側の共有メモリが残っている場合に削除する。
+        書き込み側が動作中、または別用途の共有メモリの場合はFileExistsErrorを送出する。
+        共有メモリが無い場合は何もしない。
+        """
+        try:
+            old_shm = _open_untracked(name)
+        except FileNotFoundError:
+            return
+        try:
+            magic, _, _, _, _, pid, _ = _read_header(old_shm)
+        except struct.error:
+            magic, pid = b"", 0
+        old_shm.close()
+        if magic != MAGIC:
+            raise FileExistsError(f"{name} is used by other than shared frame buffer")
+        if _is_process_alive(pid):
+            raise FileExistsError(f"{name} is used by writer process {pid}")
+        if sys.version_info < (3, 13):
+            # 3.13未満ではunlink時に登録解除されるため、登録し直してからunlinkする
+            resource_tracker.register(old_shm._name, "shared_memory")  # type: ignore
+        old_shm.unlink()
+
+    def write(
+        self,
+        frame: np.ndarray,
+        metadata: Optional[Dict[str, Any]] = None,
+        timestamp: Optional[float] = None,
+    ) -> int:
+        if frame.dtype != np.uint8:
+            raise ValueError(f"frame dtype must be uint8, got {frame.dtype}")
+        if frame.nbytes > self.data_size:
+            raise ValueError(
+                f"frame size {frame.nbytes} exceeds slot size {self.data_size}"
+            )
+        meta = b""
+        if metadata is not None:
+            meta = json.dumps(metadata).encode()
+            if len(meta) > self.meta_size:
+                raise ValueError(
+                    f"metadata size {len(meta)} exceeds slot size {self.meta_size}"
+                )
+        if timestamp is None:
+            timestamp = time.time()
+        seq = self.seq + 1
+        offset = HEADER_SIZE + (seq % self.n_slots) * self.slot_size
+        # 書き込み開始seqを先に更新し、読み込み側が書き込み途中のスロットを検出できるようにする
+        struct.pack_into("<Q", self.buf, offset, seq)
+        meta_offset = offset + SLOT_HEADER_SIZE
+        self.buf[meta_offset : meta_offset + len(meta)] = meta
+        data_offset = meta_offset + self.meta_size
+        dst = np.ndarray(
+            frame.shape, dtype=np.uint8, buffer=self.buf, offset=data_offset
+        )
+        np.copyto(dst, frame)
+        height = frame.shape[0]
+        width = frame.shape[1] if frame.ndim > 1 else 1
+        channels = frame.shape[2] if frame.ndim > 2 else 0
+        struct.pack_into(
+            "<dIIII",
+            self.buf,
+            offset + 16,
+            timestamp,
+            height,
+            width,
+            channels,
+            len(meta),
+        )
+        struct.pack_into("<Q", self.buf, offset + 8, seq)
+        struct.pack_into("<Q", self.buf, LATEST_SEQ_OFFSET, seq)
+        self.seq = seq
+        return seq
+
+    def close(self, unlink: bool = True) -> None:
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class SharedFrameReader(object):
+    """
+    SharedFrameWriterが書き込んだ共有メモリから画像を読み込むクラス
+    readで返す画像は共有メモリ上のviewなので、書き込み側がリングバッファを一周すると上書きされる。
+    保持したい場合はis_validで確認するか、copyして使うこと。
+    """
+
+    def __init__(self, name: str = DEFAULT_NAME) -> None:
+        self.name = name
+        # 書き込み側の再起動で切り離した共有メモリ。返した画像のviewが残っている間は閉じられない。
+        self.detached_shms: List[shared_memory.SharedMemory] = []
+        self._attach(_open_untracked(name))
+
+    def _attach(self, shm: shared_memory.SharedMemory) -> None:
+        (
+            magic,
+            n_slots,
+            data_size,
+            meta_size,
+            _,
+            writer_pid,
+            generation,
+        ) = _read_header(shm)
+        if magic != MAGIC:
+            shm.close()
+            raise ValueError(f"{self.name} is not a shared frame buffer")
+        self.shm = shm
+        self.buf = shm.buf
+        self.n_slots = n_slots
+        self.data_size = data_size
+        self.meta_size = meta_size
+        self.writer_pid = writer_pid
+        self.generation = generation
+        self.slot_size = SLOT_HEADER_SIZE + self.meta_size + self.data_size
+
+    def is_writer_alive(self) -> bool:
+        return _is_process_alive(self.writer_pid)
+
+    def reattach(self) -> bool:
+        """
+        書き込み側が再起動して共有メモリを作り直していた場合、新しい共有メモリに接続し直す。
+        接続し直した場合はTrueを返す。
+        """
+        try:
+            shm = _open_untracked(self.name)
+        except FileNotFoundError:
+            return False
+        try:
+            magic, _, _, _, _, _, generation = _read_header(shm)
+        except struct.error:
+            magic, generation = b"", self.generation
+        if magic != MAGIC or generation == self.generation:
+            shm.close()
+            return False
+        self.buf = None
+        self._close_shm(self.shm)
+        self._attach(shm)
+        return True
+
+    def _close_shm(self, shm: shared_memory.SharedMemory) -> None:
+        try:
+            shm.close()
+        except BufferError:
+            self.detached_shms.append(shm)
+
+    def latest_seq(self) -> int:
+        return struct.unpack_from("<Q", self.buf, LATEST_SEQ_OFFSET)[0]
+
+    def _slot_offset(self, seq: int) -> int:
+        return HEADER_SIZE + (seq % self.n_slots) * self.slot_size
+
+    def is_valid(self, seq: int) -> bool:
+        begin, end = struct.unpack_from("<QQ", self.buf, self._slot_offset(seq))
+        return begin == seq and end == seq
+
+    def read(self, seq: Optional[int] = None) -> Optional[SharedFrame]:
+        """
+        指定したseqの画像を読み込む。seqを指定しない場合は最新の画像を読み込む。
+        該当する画像が無い、または上書き中の場合はNoneを返す。
+        """
+        if seq is None:
+            seq = self.latest_seq()
+        if seq == 0:
+            return None
+        offset = self._slot_offset(seq)
+        (
+            begin,
+            end,
+            timestamp,
+            height,
+            width,
+            channels,
+            meta_len,
+        ) = struct.unpack_from(SLOT_HEADER_FORMAT, self.buf, offset)
+        if begin != seq or end != seq:
+            return None
+        shape: tuple = (height, width, channels) if channels > 0 else (height, width)
+        meta_offset = offset + SLOT_HEADER_SIZE
+        meta = bytes(self.buf[meta_offset : meta_offset + meta_len])
+        frame = np.ndarray(
+            shape,
+            dtype=np.uint8,
+            buffer=self.buf,
+            offset=meta_offset + self.meta_size,
+        )
+        # 読み込み中に書き込みが始まっていた場合は破棄する
+        if not self.is_valid(seq):
+            return None
+        metadata = json.loads(meta) if meta_len > 0 else {}
+        return SharedFrame(seq, self.generation, timestamp, frame, metadata)
+
+    def read_next(
+        self,
+        last_seq: int,
+        timeout: float = 1.0,
+        interval: float = 0.001,
+        generation: Optional[int] = None,
+        reattach_interval: float = 0.5,
+    ) -> Optional[SharedFrame]:
+        """
+        last_seqより新しい画像が書き込まれるまで待ち、最新の画像を返す。
+        新しい画像が来ない間に書き込み側の終了を検出した場合は、再起動した書き込み側に接続し直す。
+        generationにはlast_seqを取得した画像の世代を指定する。現在の世代と異なる場合はlast_seqを無視する。
+        """
+        if generation is not None and generation != self.generation:
+            last_seq = 0
+        start = time.time()
+        last_check = start
+        while time.time() - start < timeout:
+            seq = self.latest_seq()
+            if seq > last_seq:
+                shared_frame = self.read(seq)
+                if shared_frame is not None:
+                    return shared_frame
+            now = time.time()
+            if now - last_check >= reattach_interval:
+                last_check = now
+                if not self.is_writer_alive() and self.reattach():
+                    last_seq = 0
+            time.sleep(interval)
+        return None
+
+    def close(self) -> None:
+        self.buf = None
+        self.shm.close()
+        for shm in self.detached_shms:
+            shm.close()
+        self.detached_shms = []